@@ -1,113 +1,270 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+import plotly.graph_objects as go
+import plotly.io as pio
+import pyarrow.parquet as pq
 import os
+from functools import partial
 
 # ---------------- CONFIG ----------------
-st.set_page_config(page_title="Global CO2 & GDP Explorer (Local CSV)", layout="wide", page_icon="🌍")
-
-# Path to your local CSV file (relative to repo root)
+st.set_page_config(page_title="Global CO2 & GDP Explorer (Local dataset)", layout="wide", page_icon="🌍")
+# Serialize figures with orjson: numpy arrays are encoded directly, not float by float
+pio.json.config.default_engine = 'orjson'
+
+# Path to the bundled dataset (relative to repo root). The Parquet file is generated from
+# the CSV by convert_data.py; the CSV is read instead when there is no Parquet file or the
+# CSV has been modified since the Parquet file was written.
+DATA_PATH = "gdp_co2_by_country_v2.parquet"
 CSV_PATH = "gdp_co2_by_country_v2.csv"
-
-# Load CSV
-if os.path.exists(CSV_PATH):
-    try:
-        df = pd.read_csv(CSV_PATH)
-        st.sidebar.success(f"Loaded local dataset: {CSV_PATH}")
-    except Exception as e:
-        st.sidebar.error(f"Failed to read CSV: {e}")
-        df = pd.DataFrame()
-else:
-    st.sidebar.error(f"Dataset not found at: {CSV_PATH}")
-    df = pd.DataFrame()
-# Normalize column names to lowercase
-if not df.empty:
-    df.columns = [c.lower() for c in df.columns]
+# Caches keyed on the country/year selection keep at most this many entries each (shared
+# across sessions); the full dataset itself is only kept for the current and previous file.
+SELECTION_CACHE_ENTRIES = 32
 
 # ----------------- Helper column detection & calculations -----------------
 # We'll try to detect common column names. If not present, create columns when possible.
-if not df.empty:
-    # ensure 'country' and 'year' exist
-    if 'country' not in df.columns:
-        # try variants
-        for col in df.columns:
-            if 'country' in col:
-                df = df.rename(columns={col: 'country'})
-                break
-    if 'year' not in df.columns:
-        for col in df.columns:
-            if 'year' in col:
-                df = df.rename(columns={col: 'year'})
+# Canonical column name -> rule matching a (lowercased) source column name.
+# The first source column matching a rule is renamed, unless the canonical name already exists.
+COLUMN_ALIASES = {
+    'country': lambda c: 'country' in c,
+    'year': lambda c: 'year' in c,
+    'co2': lambda c: c == 'co2' or 'co2_' in c or c.endswith('co2'),
+    'population': lambda c: 'pop' in c and c != 'co2_per_capita',
+    'gdp': lambda c: 'gdp' in c and 'per' not in c,
+    'gdp_per_capita': lambda c: 'gdp_per_capita' in c or 'gdp_pc' in c,
+    'co2_per_capita': lambda c: 'co2_per_capita' in c or (c.endswith('per_capita') and 'co2' in c),
+}
+
+
+def _detect_columns(columns):
+    # Map detected variants onto the canonical names in a single pass over the (lowercased) columns
+    rename = {}
+    found = set(columns)
+    for c in columns:
+        for canon, matches in COLUMN_ALIASES.items():
+            if canon not in found and matches(c):
+                rename[c] = canon
+                found.add(canon)
                 break
+    return rename
 
-    # ensure numeric columns are proper dtype
-    num_cols = df.select_dtypes(include=['number']).columns.tolist()
-    # co2 column
-    if 'co2' not in df.columns:
-        for c in df.columns:
-            if 'co2' == c or 'co2_' in c or c.endswith('co2'):
-                df = df.rename(columns={c: 'co2'})
-                break
-    # population
-    if 'population' not in df.columns:
-        for c in df.columns:
-            if 'pop' in c and c != 'co2_per_capita':
-                df = df.rename(columns={c: 'population'})
-                break
-    # gdp
-    if 'gdp' not in df.columns:
-        for c in df.columns:
-            if 'gdp' in c and 'per' not in c:
-                df = df.rename(columns={c: 'gdp'})
-                break
-    # gdp_per_capita
-    if 'gdp_per_capita' not in df.columns:
-        for c in df.columns:
-            if 'gdp_per_capita' in c or 'gdp_pc' in c:
-                df = df.rename(columns={c: 'gdp_per_capita'})
-                break
-    # co2_per_capita
-    if 'co2_per_capita' not in df.columns:
-        for c in df.columns:
-            if 'co2_per_capita' in c or c.endswith('per_capita') and 'co2' in c:
-                df = df.rename(columns={c: 'co2_per_capita'})
-                break
 
-    # Convert columns to numeric where possible
+def _used_columns(header):
+    # Source columns that column detection picks (or that are already canonical), in file order
+    lowered = [c.lower() for c in header]
+    wanted = set(_detect_columns(lowered)) | set(COLUMN_ALIASES) | {'cumulative_co2', 'co2_per_gdp'}
+    return [c for c, low in zip(header, lowered) if low in wanted]
+
+
+def _read_csv(path):
+    # Only parse the used columns. Header and body are both read with the default C engine,
+    # which tolerates ragged rows in user files and mangles duplicate names the same way.
+    usecols = _used_columns(pd.read_csv(path, nrows=0).columns)
+    return pd.read_csv(path, usecols=usecols or None)
+
+
+def _read_parquet(path):
+    # Project onto the used columns, detected from the schema like the CSV header
+    columns = _used_columns(pq.read_schema(path).names)
+    # memory_map=True lets pyarrow read the compressed pages straight from the mapped file
+    # instead of first copying them into its own buffers; columns are still decoded into new memory
+    return pq.read_table(path, columns=columns or None, memory_map=True).to_pandas(self_destruct=True)
+
+
+def _normalize(df):
+    # Normalize column names to lowercase
+    df.columns = [c.lower() for c in df.columns]
+
+    df = df.rename(columns=_detect_columns(df.columns))
+
+    # Convert columns to numeric where possible; float32 is plenty for these values
+    # and halves the memory every later groupby/transform has to stream through
     for c in ['co2','population','gdp','gdp_per_capita','co2_per_capita']:
         if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
+            df[c] = pd.to_numeric(df[c], errors='coerce').astype('float32')
+    if 'year' in df.columns:
+        year = pd.to_numeric(df['year'], errors='coerce')
+        if year.notna().all():
+            df['year'] = year.astype('int16')
+    if 'country' in df.columns:
+        # Filtering and grouping use the integer codes; the cast only makes the ~200 category
+        # labels Arrow-backed on pandas 2.x (pandas 3 already stores str as pyarrow)
+        df['country'] = df['country'].astype('string[pyarrow]').astype('category')
+    return df
+
+
+def _segmented_cumsum(codes, values):
+    # Running sum of values that restarts whenever codes changes (codes must be grouped together).
+    # Missing values are skipped like groupby().cumsum(); rows with a missing key (code -1) get NaN.
+    missing = np.isnan(values)
+    filled = np.where(missing, 0.0, values)
+    running = np.cumsum(filled)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    segment = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(codes)]))
+    out = running - (running - filled)[starts][segment]
+    out[missing | (codes < 0)] = np.nan
+    return out
+
+
+def _group_totals(codes, values):
+    # Per-row sum of values over all rows sharing the same code (like groupby().transform('sum')).
+    # Missing values are skipped; rows with a missing key (code -1) get a total of 0.
+    valid = codes >= 0
+    filled = np.where(np.isnan(values) | ~valid, 0.0, values)
+    sums = np.bincount(codes[valid], weights=filled[valid])
+    return np.where(valid, sums[np.maximum(codes, 0)] if len(sums) else 0.0, 0.0)
+
+
+def _ratio(df, num, den):
+    # num / den in one numpy pass; NaN where the denominator is missing, zero or negative
+    n = df[num].to_numpy()
+    d = df[den].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.divide(n, d, out=np.full_like(n, np.nan), where=d > 0)
+
+
+def _derive(df):
+    # Sort once by (country, year) with integer keys instead of sorting the strings; the
+    # cumulative sum needs this order and the plots can then use filtered slices as-is.
+    # Without a country column, sort by year alone so each line still runs left to right.
+    if 'country' in df.columns and 'year' in df.columns:
+        codes, _ = pd.factorize(df['country'], sort=True)
+        order = np.lexsort((df['year'].to_numpy(), codes))
+        df = df.iloc[order].reset_index(drop=True)
+        codes = codes[order]
+    elif 'year' in df.columns:
+        df = df.iloc[np.argsort(df['year'].to_numpy(), kind='stable')].reset_index(drop=True)
 
     # Compute derived columns safely
     # 1) co2 per capita: if missing, compute from co2 and population
     if 'co2_per_capita' not in df.columns and 'co2' in df.columns and 'population' in df.columns:
-        df['co2_per_capita'] = df['co2'] / df['population']
+        df['co2_per_capita'] = _ratio(df, 'co2', 'population')
 
     # 2) cumulative_co2 per country
     if 'cumulative_co2' not in df.columns and 'co2' in df.columns and 'country' in df.columns and 'year' in df.columns:
-        df = df.sort_values(['country','year'])
-        df['cumulative_co2'] = df.groupby('country')['co2'].cumsum()
-
-    # 3) global total co2 per year for percentage
-    if 'co2' in df.columns and 'year' in df.columns:
-        df['global_total_co2'] = df.groupby('year')['co2'].transform('sum')
-        # avoid division by zero
-        df['co2_pct'] = (df['co2'] / df['global_total_co2'] * 100).fillna(0)
-
-    # 4) GDP percent: country gdp / global gdp per year
-    if 'gdp' in df.columns and 'year' in df.columns:
-        df['global_total_gdp'] = df.groupby('year')['gdp'].transform('sum')
-        df['gdp_pct'] = (df['gdp'] / df['global_total_gdp'] * 100).fillna(0)
+        df['cumulative_co2'] = _segmented_cumsum(codes, df['co2'].to_numpy(dtype='float64')).astype('float32')
+
+    # 3) & 4) share of the global total per year: country co2 / global co2, country gdp / global gdp
+    pct_cols = [c for c in ['co2','gdp'] if c in df.columns] if 'year' in df.columns else []
+    if pct_cols:
+        # factorize year once and sum each column per year with bincount instead of a groupby
+        year_codes, _ = pd.factorize(df['year'])
+        for c in pct_cols:
+            values = df[c].to_numpy(dtype='float64')
+            total = _group_totals(year_codes, values)
+            # avoid division by zero; missing values count as 0%
+            pct = np.divide(values, total, out=np.zeros(len(df)), where=(total != 0) & ~np.isnan(values)) * 100
+            df[f'{c}_pct'] = pct.astype('float32')
 
     # 5) gdp per capita (if missing and population & gdp exist)
     if 'gdp_per_capita' not in df.columns and 'gdp' in df.columns and 'population' in df.columns:
         # assuming gdp is total GDP; if gdp is per capita already this will be wrong — user should verify
-        df['gdp_per_capita'] = df['gdp'] / df['population']
+        df['gdp_per_capita'] = _ratio(df, 'gdp', 'population')
 
     # 6) co2 per gdp
     if 'co2_per_gdp' not in df.columns and 'co2' in df.columns and 'gdp' in df.columns:
-        # avoid division by zero
-        df['co2_per_gdp'] = df['co2'] / df['gdp'].replace({0: pd.NA})
+        df['co2_per_gdp'] = _ratio(df, 'co2', 'gdp')
+    return df
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_data(path, mtime):
+    # mtime is only part of the cache key, so editing the file invalidates the cache
+    if path.endswith('.parquet'):
+        df = _read_parquet(path)
+    else:
+        df = _read_csv(path)
+    if df.empty:
+        return df
+    df = _normalize(df)
+    df = _derive(df)
+    return df
+
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def country_list(path, mtime):
+    # categories are the sorted distinct countries, no need to scan the column
+    return load_data(path, mtime)['country'].cat.categories.tolist()
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def filter_data(path, mtime, countries, years):
+    # st.cache_data hands out its own copy of df, so combine all filters into one mask
+    # and index once instead of copying and re-indexing the frame per filter
+    df = load_data(path, mtime)
+    if df.empty:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    if countries:
+        # compare the small integer category codes instead of hashing country strings
+        country = df['country'].cat
+        selected_codes = np.flatnonzero(country.categories.isin(countries))
+        mask &= np.isin(country.codes.to_numpy(), selected_codes)
+    if years and 'year' in df.columns:
+        year = df['year'].to_numpy()
+        mask &= (year >= years[0]) & (year <= years[1])
+    return df.iloc[mask]
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def master_table(path, mtime, countries, years, columns):
+    # project onto the master columns in one step; any missing column comes back as NaN
+    return filter_data(path, mtime, countries, years).reindex(columns=list(columns))
+
+
+@st.cache_data(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def master_csv(path, mtime, countries, years, columns):
+    return master_table(path, mtime, countries, years, columns).to_csv(index=False)
+
+
+def line_figure(data, metric):
+    # Build one WebGL trace per country straight from numpy arrays; skips plotly express'
+    # DataFrame introspection. observed=True leaves out countries with no rows in data.
+    x_col = 'year' if 'year' in data.columns else None
+    if 'country' in data.columns:
+        groups = data.groupby('country', sort=False, observed=True)
+    else:
+        groups = [(None, data)]
+    traces = [go.Scattergl(x=g[x_col].to_numpy() if x_col else g.index.to_numpy(),
+                           y=g[metric].to_numpy(),
+                           name=str(c) if c is not None else None,
+                           mode='lines+markers')
+              for c, g in groups]
+    fig = go.Figure(traces)
+    fig.update_layout(title=f"{metric} over time",
+                      xaxis_title=x_col or 'index',
+                      yaxis_title=metric,
+                      legend_title_text='country')
+    return fig
+
+
+@st.cache_resource(show_spinner=False, max_entries=SELECTION_CACHE_ENTRIES)
+def metric_figure(path, mtime, countries, years, metric):
+    # Keyed on the metric and the selection, so changing one chart's metric (or any other
+    # widget) reuses the other chart's Figure instead of rebuilding it
+    return line_figure(filter_data(path, mtime, countries, years), metric)
+
+
+# Load dataset (Parquet if available and up to date, otherwise fall back to the CSV)
+data_path = CSV_PATH
+if os.path.exists(DATA_PATH):
+    if os.path.exists(CSV_PATH) and os.path.getmtime(CSV_PATH) > os.path.getmtime(DATA_PATH):
+        st.sidebar.warning(f"{CSV_PATH} is newer than {DATA_PATH}, reading the CSV instead. "
+                           "Run `python convert_data.py` to regenerate the Parquet file.")
+    else:
+        data_path = DATA_PATH
+data_mtime = None
+if os.path.exists(data_path):
+    try:
+        data_mtime = os.path.getmtime(data_path)
+        df = load_data(data_path, data_mtime)
+        st.sidebar.success(f"Loaded local dataset: {data_path}")
+    except Exception as e:
+        st.sidebar.error(f"Failed to read dataset: {e}")
+        df = pd.DataFrame()
+else:
+    st.sidebar.error(f"Dataset not found at: {data_path}")
+    df = pd.DataFrame()
 
 # ----------------- Sidebar (filters) -----------------
 st.title("🌍 CO₂ Emission & Global GDP Explorer")
@@ -119,7 +276,7 @@ if df.empty:
 
 # Country selector (multi-select)
 if 'country' in df.columns and not df.empty:
-    countries = sorted(df['country'].dropna().unique())
+    countries = country_list(data_path, data_mtime)
     selected_countries = st.sidebar.multiselect("Select countries (leave empty = All)", options=countries, default=countries[:3])
 else:
     selected_countries = []
@@ -143,14 +300,18 @@ available_gdp = [c for c in gdp_options if c in df.columns]
 selected_gdp_metric = st.sidebar.selectbox("GDP metric to plot", options=available_gdp if available_gdp else ['(none available)'])
 
 # ----------------- Data filtering -----------------
-filtered = df.copy()
-if not filtered.empty:
-    if selected_countries:
-        filtered = filtered[filtered['country'].isin(selected_countries)]
-    if selected_years and 'year' in filtered.columns:
-        filtered = filtered[(filtered['year'] >= selected_years[0]) & (filtered['year'] <= selected_years[1])]
+# Cached on the selection so unrelated widget changes (e.g. metric selectors) reuse the slice.
+# Countries are sorted so picking the same set in a different order hits the same entry.
+filter_key = (tuple(sorted(selected_countries)), tuple(selected_years) if selected_years else None)
+if df.empty:
+    filtered = df
+else:
+    filtered = filter_data(data_path, data_mtime, *filter_key)
 
 # ----------------- Plots -----------------
+# filtered is already sorted by (country, year), or by year when there is no country column,
+# from load_data, so it is plotted without re-sorting.
+# Lines are drawn with WebGL (Scattergl) so many countries x years stay responsive in the browser
 st.markdown("---")
 col1, col2 = st.columns(2)
 
@@ -159,12 +320,7 @@ with col1:
     if filtered.empty or selected_co2_metric == '(none available)':
         st.info("CO₂ metric not available or no data selected.")
     else:
-        fig = px.line(filtered.sort_values('year') if 'year' in filtered.columns else filtered,
-                      x='year' if 'year' in filtered.columns else (filtered.index),
-                      y=selected_co2_metric,
-                      color='country' if 'country' in filtered.columns else None,
-                      markers=True,
-                      title=f"{selected_co2_metric} over time")
+        fig = metric_figure(data_path, data_mtime, *filter_key, selected_co2_metric)
         st.plotly_chart(fig, use_container_width=True)
 
 with col2:
@@ -172,12 +328,7 @@ with col2:
     if filtered.empty or selected_gdp_metric == '(none available)':
         st.info("GDP metric not available or no data selected.")
     else:
-        fig2 = px.line(filtered.sort_values('year') if 'year' in filtered.columns else filtered,
-                       x='year' if 'year' in filtered.columns else (filtered.index),
-                       y=selected_gdp_metric,
-                       color='country' if 'country' in filtered.columns else None,
-                       markers=True,
-                       title=f"{selected_gdp_metric} over time")
+        fig2 = metric_figure(data_path, data_mtime, *filter_key, selected_gdp_metric)
         st.plotly_chart(fig2, use_container_width=True)
 
 # ----------------- Master table -----------------
@@ -190,15 +341,11 @@ existing_master_cols = [c for c in master_cols if c in df.columns]
 if filtered.empty:
     st.write("No data to show in master table. Adjust filters or check data.")
 else:
-    master_df = filtered.copy()
-    # ensure columns exist in master_df; if missing, create with NaN
-    for c in master_cols:
-        if c not in master_df.columns:
-            master_df[c] = pd.NA
-    master_df = master_df[master_cols]
+    master_df = master_table(data_path, data_mtime, *filter_key, tuple(master_cols))
     st.dataframe(master_df.reset_index(drop=True))
-    csv = master_df.to_csv(index=False)
-    st.download_button("Download master table (CSV)", data=csv, file_name="master_table.csv")
+    # Pass a callable so the CSV is only serialized when the button is actually clicked
+    csv = partial(master_csv, data_path, data_mtime, *filter_key, tuple(master_cols))
+    st.download_button("Download master table (CSV)", data=csv, file_name="master_table.csv", mime="text/csv")
 
 st.markdown("---")
 st.caption("Notes: The app attempts to detect and compute derived metrics (percentages, per-capita, cumulative) when possible. Verify column meanings in your CSV for correctness.")
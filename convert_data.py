@@ -0,0 +1,13 @@
+import pandas as pd
+
+# One-off preprocessing step: convert the bundled CSV dataset to Parquet so the app
+# can load it without re-parsing text on every cold start.
+# Run from the repo root whenever gdp_co2_by_country_v2.csv changes:
+#     python convert_data.py
+CSV_PATH = "gdp_co2_by_country_v2.csv"
+DATA_PATH = "gdp_co2_by_country_v2.parquet"
+
+if __name__ == "__main__":
+    df = pd.read_csv(CSV_PATH)
+    df.to_parquet(DATA_PATH, compression="snappy", index=False)
+    print(f"Wrote {len(df)} rows to {DATA_PATH}")